@@ -1,8 +1,13 @@
 import os
+import re
 import json
+import hashlib
 import requests
-from bs4 import BeautifulSoup
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from selectolax.lexbor import LexborHTMLParser
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
 
 
 # ========= 从环境变量里读配置（GitHub Secrets 会传进来） =========
@@ -16,6 +21,17 @@ ONLY_ON_CHANGE = os.environ.get("ONLY_ON_CHANGE", "false").lower() == "true"
 LAST_STOCK_FILE = "last_stock.json"
 # =============================================================
 
+# ========= 由配置推导出来的常量，启动时算一次 =========
+_URLS = tuple(u.strip() for u in RAW_TARGET_URL.split(",") if u.strip())
+_TG_URL = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+
+# 库存那一行里 “库存” 后面的第一个数字
+_STOCK_RE = re.compile(r"库存\D*(\d+)")
+
+# 库存状态文案，按 bool(库存) 取：0 -> 售罄，非 0 -> 有货
+_STATUS = ("售罄 ❌", "有货 ✅")
+# =============================================================
+
 
 def parse_cookies(cookie_str: str):
     """
@@ -32,104 +48,205 @@ def parse_cookies(cookie_str: str):
     return cookies
 
 
+# Cookie 字符串只在启动时解析一次
+_COOKIES = parse_cookies(COOKIE)
+
+# 全局复用一个 Session：同一域名的多个页面和 Telegram 请求共用连接池，省掉重复的 TCP/TLS 握手
+SESSION = requests.Session()
+SESSION.headers.update({
+    "User-Agent": "Mozilla/5.0",
+    # 声明支持压缩，页面下载字节数能少好几倍（br 需要装 brotli，urllib3 会自动解压）
+    "Accept-Encoding": "br, gzip, deflate",
+})
+# Cookie 只挂在目标站点的域名下，避免跟着 Telegram 请求发出去
+_hosts = {urlsplit(u).hostname for u in _URLS}
+# 没写 scheme 的 URL 取不到 hostname，这里先跳过，留给 fetch_stock 报错并发告警
+for _host in _hosts - {None}:
+    for _k, _v in _COOKIES.items():
+        SESSION.cookies.set(_k, _v, domain=_host)
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
+
 def send_tg_message(text: str):
     """
     发 Telegram 消息（纯文本）
     """
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-    data = {
-        "chat_id": CHAT_ID,
-        "text": text,
-    }
-    r = requests.post(url, data=data, timeout=10)
-    r.raise_for_status()
+    SESSION.post(
+        _TG_URL,
+        data={"chat_id": CHAT_ID, "text": text},
+        timeout=10,
+    ).raise_for_status()
 
 
-def fetch_stock_from_url(url: str):
+def read_body(resp):
     """
-    从单个 URL 解析库存，返回 dict
+    取响应正文给 lexbor 解析：
+    响应头声明了非 UTF-8 的 charset 时按它解码成 str，否则直接返回原始字节
     """
-    headers = {
-        "User-Agent": "Mozilla/5.0",
-    }
-
-    resp = requests.get(
-        url,
-        headers=headers,
-        cookies=parse_cookies(COOKIE),
-        timeout=20,
-    )
-    resp.raise_for_status()
-    soup = BeautifulSoup(resp.text, "html.parser")
+    content_type = resp.headers.get("Content-Type", "").lower()
+    charset = content_type.partition("charset=")[2].split(";")[0].strip(" \"'")
+    if charset and charset not in ("utf-8", "utf8"):
+        return resp.text
+    return resp.content
+
 
+def parse_html(html):
+    """
+    解析页面：bytes 由 lexbor 按 BOM / <meta charset> 识别编码（没有声明就按 UTF-8），
+    str 已经解码过，直接解析
+    """
+    return LexborHTMLParser(html, encoding=True)
+
+
+def page_key(url: str) -> str:
+    """
+    页面缓存用的 key：URL 来自 Secrets，不能明文写进仓库里的 last_stock.json
+    """
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+
+
+def fetch_html(url: str, cached=None):
+    """
+    下载单个 URL 的页面，返回 (页面内容, 缓存校验头)，页面内容见 read_body
+    cached 是上次保存的 {"etag", "last_modified", "names"}，页面没变（304）时内容为 None
+    """
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    with SESSION.get(url, headers=headers, timeout=20) as resp:
+        if cached and resp.status_code == 304:
+            return None, {
+                "etag": resp.headers.get("ETag", cached.get("etag")),
+                "last_modified": cached.get("last_modified"),
+            }
+        resp.raise_for_status()
+        return read_body(resp), {
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+        }
+
+
+def parse_stock(tree: LexborHTMLParser):
+    """
+    从解析好的页面里提取库存，返回 dict
+    """
     result = {}
 
     # 所有商品卡片：class 里同时有 card 和 cartitem
-    cards = soup.select("div.card.cartitem")
+    cards = tree.css("div.card.cartitem")
 
     for card in cards:
         # 标题，例如 "HK-②"、"CA"、"DE"、"FR-①"、"FR-②"、以后新增的地区等
-        title_tag = card.find("h4")
+        title_tag = card.css_first("h4")
         if not title_tag:
             continue
 
-        name = title_tag.get_text(strip=True)
+        name = title_tag.text(strip=True)
         if not name:
             continue
 
         # 页面里可能有多个 p.card-text，要找包含“库存”的那个
-        stock_tag = None
-        for p in card.find_all("p", class_="card-text"):
-            if "库存" in p.get_text():
-                stock_tag = p
-                break
-
+        stock_tag = next(
+            (p for p in card.css("p.card-text") if "库存" in p.text()),
+            None,
+        )
         if not stock_tag:
             continue
 
-        stock_text = stock_tag.get_text(strip=True)
-        digits = "".join(ch for ch in stock_text if ch.isdigit())
-        if not digits:
+        # 只在库存这一行里取数字，“已售罄” 之类没有数字的直接跳过
+        m = _STOCK_RE.search(stock_tag.text())
+        if not m:
             continue
 
-        result[name] = int(digits)
+        result[name] = int(m.group(1))
 
     return result
 
 
-def fetch_stock():
+def fetch_stock(state=None):
     """
-    支持多个页面：把所有 URL 的库存合并到一个 dict
+    支持多个页面：并发抓取、并发解析所有 URL，把库存合并到一个 dict
+    state 是上次保存的状态（见 load_state），返回 (库存, 新的页面缓存)
     """
-    urls = [u.strip() for u in RAW_TARGET_URL.split(",") if u.strip()]
+    last_stock = state["stock"] if state else {}
+    pages = state["pages"] if state else {}
+    if not _URLS:
+        return {}, {}
+
+    keys = [page_key(u) for u in _URLS]
+    # 只有记着商品名的缓存才能在 304 时还原出这个页面的库存，格式不对的当作没缓存
+    cached = []
+    for k in keys:
+        entry = pages.get(k)
+        valid = isinstance(entry, dict) and isinstance(entry.get("names"), list)
+        cached.append(entry if valid else None)
+
+    with ThreadPoolExecutor(max_workers=min(8, len(_URLS))) as ex:
+        # 多个页面同时请求，总耗时约等于最慢的那个页面
+        fetched = list(ex.map(fetch_html, _URLS, cached))
+        # 解析也是各页面互不相关的，同样丢进线程池；没变的页面（304）直接跳过
+        changed = [html for html, _ in fetched if html is not None]
+        trees = iter(list(ex.map(parse_html, changed)))
 
     total = {}
-    for url in urls:
-        part = fetch_stock_from_url(url)
+    new_pages = {}
+    for key, entry, (html, validators) in zip(keys, cached, fetched):
+        if html is None:
+            # 页面没变：库存数量直接从上次的总库存里取，不在文件里重复存一份
+            part = {k: last_stock[k] for k in entry["names"] if k in last_stock}
+        else:
+            part = parse_stock(next(trees))
         total.update(part)
+        # 服务器给了 ETag / Last-Modified 才缓存，下次可以带条件请求
+        if validators["etag"] or validators["last_modified"]:
+            new_pages[key] = dict(validators, names=list(part))
 
-    return total
+    return total, new_pages
 
 
-def load_last_stock():
+def load_state():
     """
-    从 last_stock.json 读取上一次库存
+    从 last_stock.json 读取上一次的状态：
+    { "stock": { 名称: 库存, ... }, "pages": { 页面 key: 缓存, ... } }
     """
     if not os.path.exists(LAST_STOCK_FILE):
         return None
     try:
         with open(LAST_STOCK_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+            data = json.load(f)
     except Exception:
         return None
+    if not isinstance(data, dict):
+        return None
+
+    # 兼容旧格式：文件里直接就是库存 dict
+    if not isinstance(data.get("stock"), dict):
+        return {"stock": data, "pages": {}}
+    if not isinstance(data.get("pages"), dict):
+        data["pages"] = {}
+    return data
 
 
-def save_stock(stock_dict):
+def save_state(stock_dict, pages):
     """
-    把当前库存写入 last_stock.json
+    把当前库存和页面缓存写入 last_stock.json
+    先写临时文件再 os.replace，中途出错也不会留下写了一半的文件
     """
-    with open(LAST_STOCK_FILE, "w", encoding="utf-8") as f:
-        json.dump(stock_dict, f, ensure_ascii=False, indent=2)
+    tmp = LAST_STOCK_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(
+            {"stock": stock_dict, "pages": pages},
+            f,
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+    os.replace(tmp, LAST_STOCK_FILE)
 
 
 def diff_stock(old, new):
@@ -137,33 +254,21 @@ def diff_stock(old, new):
     对比新旧库存，返回发生变化的条目：
     { 名称: (旧值, 新值), ... }
     """
-    changes = {}
-    all_keys = sorted(set(old.keys()) | set(new.keys()))
-    for k in all_keys:
-        o = old.get(k)
-        n = new.get(k)
-        if o != n:
-            changes[k] = (o, n)
-    return changes
+    # 只在一边出现的（新增 / 下架）+ 两边都有但数量变了的；不排序，展示时再排
+    added_or_removed = {k: (old.get(k), new.get(k)) for k in old.keys() ^ new.keys()}
+    updated = {k: (old[k], new[k]) for k in old.keys() & new.keys() if old[k] != new[k]}
+    return added_or_removed | updated
 
 
-def build_full_message(stock_dict, mode: str) -> str:
+def build_full_message(stock_dict, mode: str, now_utc: str) -> str:
     """
     输出完整库存列表
     """
-    now_utc = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
-
-    # 简单分组：名字以 HK 开头的放一组，其它一组
-    hk = {}
-    other = {}
-    for k, v in stock_dict.items():
-        if k.startswith("HK"):
-            hk[k] = v
-        else:
-            other[k] = v
-
-    hk = dict(sorted(hk.items(), key=lambda x: x[0]))
-    other = dict(sorted(other.items(), key=lambda x: x[0]))
+    # 简单分组：名字以 HK 开头的排前面，其它排后面，组内按名字排序
+    items = sorted(
+        stock_dict.items(),
+        key=lambda x: (0 if x[0].startswith("HK") else 1, x[0]),
+    )
 
     if mode == "daily":
         title = "📊 IDC 每日库存汇总"
@@ -172,31 +277,29 @@ def build_full_message(stock_dict, mode: str) -> str:
 
     lines = [title, ""]
 
-    if hk:
-        lines.append("【HK 区（避孕套）】")
-        for k, v in hk.items():
-            status = "售罄 ❌" if v == 0 else "有货 ✅"
-            lines.append(f"{k}: {v}（{status}）")
-        lines.append("")
-
-    if other:
-        lines.append("【其他区】")
-        for k, v in other.items():
-            status = "售罄 ❌" if v == 0 else "有货 ✅"
-            lines.append(f"{k}: {v}（{status}）")
+    prev_hk = None
+    for k, v in items:
+        is_hk = k.startswith("HK")
+        # 分组切换时补上组标题，两组之间空一行
+        if is_hk != prev_hk:
+            if prev_hk is not None:
+                lines.append("")
+            lines.append("【HK 区（避孕套）】" if is_hk else "【其他区】")
+            prev_hk = is_hk
+        lines.append(f"{k}: {v}（{_STATUS[bool(v)]}）")
+
+    if items:
         lines.append("")
 
     lines.append(f"更新时间：{now_utc}")
     return "\n".join(lines)
 
 
-def build_change_message(changes: dict, mode: str) -> str:
+def build_change_message(changes: dict, mode: str, now_utc: str) -> str:
     """
     只输出发生变化的条目
     changes: { name: (old, new), ... }
     """
-    now_utc = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
-
     if mode == "daily":
         title = "📊 IDC 库存变动汇总"
     else:
@@ -233,8 +336,10 @@ def build_change_message(changes: dict, mode: str) -> str:
 
 
 def main():
+    state = load_state()
+
     try:
-        current = fetch_stock()
+        current, pages = fetch_stock(state)
     except Exception as e:
         msg = f"⚠️ 库存监控抓取失败：{e}"
         print(msg)
@@ -247,21 +352,24 @@ def main():
         send_tg_message(msg)
         return
 
-    last = load_last_stock()
+    # 本次运行的时间，所有消息共用
+    now_utc = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
 
     # 第一次运行：没有历史数据，直接发完整库存，并写入 last_stock.json
-    if last is None:
-        save_stock(current)
-        msg = build_full_message(current, MODE) + "\n\n(首次采集)"
+    if state is None:
+        save_state(current, pages)
+        msg = build_full_message(current, MODE, now_utc) + "\n\n(首次采集)"
         print("First run, sending full stock.")
         send_tg_message(msg)
         return
 
     # 有历史数据，对比变化
-    changes = diff_stock(last, current)
+    changes = diff_stock(state["stock"], current)
 
-    # 把最新库存写入文件（供下次对比）
-    save_stock(current)
+    # 库存有变化才写文件（供下次对比）；只是校验头变了不写，
+    # 否则仓库里的 last_stock.json 会被反复提交，旧校验头最多让下次多下载一次整页
+    if changes:
+        save_state(current, pages)
 
     if not changes:
         print("No stock changes.")
@@ -270,15 +378,15 @@ def main():
             return
         else:
             # 每次都推送：发完整库存
-            msg = build_full_message(current, MODE)
+            msg = build_full_message(current, MODE, now_utc)
             send_tg_message(msg)
             return
 
     # 有变化
     if ONLY_ON_CHANGE:
-        msg = build_change_message(changes, MODE)
+        msg = build_change_message(changes, MODE, now_utc)
     else:
-        msg = build_full_message(current, MODE)
+        msg = build_full_message(current, MODE, now_utc)
 
     print("Stock changed, sending notification.")
     send_tg_message(msg)